@@ -20,11 +20,20 @@ Detects model via IN_TYPE, then allows:
  - configuring watchdog (data-flow monitor)
 """
 
+import functools
+import re
 import serial
 import time
 from typing import Union
 
+from serialbus import SerialBus, fd_drain, fd_read_until, fd_write
+
+# Reply: optional STX, payload, optional ETX, trailing CRLF
+_REPLY_RE = re.compile(rb'^\s*\x02?(.*?)\x03?\s*$', re.DOTALL)
+
 class IkaLabDevice:
+    __slots__ = ('device', 'timeout', 'ser', '_lock', '_fd', '_model', '_queries', '_sp_prefixes')
+
     NAMUR_CMDS = {
         # Identification
         'IN_TYPE': 'IN_TYPE',
@@ -48,50 +57,113 @@ class IkaLabDevice:
         'STATUS_90':'STATUS_90',
     }
 
+    # Bound str.format of the parameterized templates above, so each call
+    # skips the dict lookup and the keyword-field parse
+    _IN_PV   = 'IN_PV_{}'.format
+    _IN_SP   = 'IN_SP_{}'.format
+    _OUT_SP  = 'OUT_SP_{}@{}'.format
+    _START   = 'START_{}'.format
+    _STOP    = 'STOP_{}'.format
+    _OUT_WD1 = 'OUT_WD1@{}'.format
+    _OUT_WD2 = 'OUT_WD2@{}'.format
+
     def __init__(self, device: str = '/dev/ttyUSB0', baud: int = 9600, timeout: float = 0.5):
-        """Open serial port (9600, 7E1, no flow control)."""
+        """Open serial port (9600, 7E1, no flow control); raise RuntimeError on failure."""
         self.device = device
+        self.timeout = timeout
+        self._model = None
+        # Per-channel pre-encoded commands, built on first use (see _query_for)
+        self._queries = {}
+        self._sp_prefixes = {}
         try:
-            self.ser = serial.Serial(
-                port=self.device, baudrate=baud,
+            self.ser = SerialBus.get(
+                self.device, baud,
                 bytesize=serial.SEVENBITS, parity=serial.PARITY_EVEN,
-                stopbits=serial.STOPBITS_ONE, timeout=timeout,
-                xonxoff=False, rtscts=False, dsrdtr=False
+                stopbits=serial.STOPBITS_ONE, timeout=timeout
             )
-            time.sleep(0.1)
-            self.ser.reset_input_buffer()
-            self.ser.reset_output_buffer()
+            self._lock = SerialBus.lock_for(self.device)
+            self._fd = self.ser.fileno()
             print(f"Opened {self.device} @ {baud} baud (7E1, no flow control)")
         except Exception as e:
-            print(f"ERROR opening {self.device}: {e}")
-            self.ser = None
+            raise RuntimeError(f"Failed to open {self.device}: {e}") from e
 
     def close(self):
-        """Close the serial port."""
-        if self.ser and self.ser.is_open:
-            self.ser.close()
-            print("Serial port closed.")
-
-    def _send(self, cmd: str, pause: float = 0.1) -> str:
-        """Send ASCII command+CRLF, return stripped reply."""
-        if not self.ser or not self.ser.is_open:
-            raise RuntimeError("Serial port not open")
-        full = cmd + "\r\n"
-        self.ser.write(full.encode('ascii'))
-        time.sleep(pause)
-        raw = self.ser.read_all()
-        text = raw.decode('ascii', errors='ignore').strip()
-        # Strip leading STX/ETX if present
-        if text.startswith('\x02') and text.endswith('\x03'):
-            text = text[1:-1]
-        return text
+        """Release the serial port; it is closed once no other driver uses it."""
+        if self.ser:
+            if SerialBus.release(self.device):
+                print("Serial port closed.")
+            self.ser = None
+            self._fd = -1
+
+    def _send(self, cmd: str, expect_response: bool = True) -> str:
+        """
+        Send ASCII command+CRLF. If expect_response, read up to the CRLF ending
+        the reply and return it stripped; otherwise return "" without waiting.
+        Only the IN_* queries, STATUS_90 and the echoing OUT_WD1/OUT_WD2 and
+        OUT_SP_12/OUT_SP_42 answer; OUT_SP_X, START_X, STOP_X and RESET do not.
+        """
+        return self._send_frame((cmd + "\r\n").encode('ascii'), expect_response)
+
+    def _send_frame(self, frame: bytes, expect_response: bool = True) -> str:
+        """Write an already encoded, CRLF-terminated command and return the stripped reply."""
+        fd = self._fd
+        with self._lock:
+            fd_drain(fd)
+            fd_write(fd, frame, self.timeout)
+            if not expect_response:
+                time.sleep(0.05)
+                return ""
+            raw = fd_read_until(fd, b'\r\n', self.timeout)
+        return self._parse_reply(raw)
+
+    def _query_for(self, template, channel):
+        """
+        Return a no-argument callable sending template(channel), encoded once
+        on first use, so repeated polls of one channel skip format and encode.
+        """
+        key = (template, channel)
+        query = self._queries.get(key)
+        if query is None:
+            frame = (template(channel) + "\r\n").encode('ascii')
+            query = self._queries[key] = functools.partial(self._send_frame, frame)
+        return query
+
+    @staticmethod
+    def _parse_reply(raw: bytes) -> str:
+        """Decode a reply, dropping STX/ETX framing and surrounding whitespace."""
+        return _REPLY_RE.match(raw).group(1).decode('ascii', errors='ignore').strip()
+
+    async def asend(self, cmd: str, expect_response: bool = True) -> str:
+        """
+        Coroutine version of _send for any NAMUR command (e.g. 'IN_PV_1'):
+        await the CRLF-terminated reply on the event loop instead of blocking.
+        Pass expect_response=False for commands that get no reply (OUT_SP_X,
+        START_X, STOP_X, RESET); "" is returned once they are written.
+        """
+        raw = await SerialBus.aexchange(self.device, self._fd, (cmd + "\r\n").encode('ascii'),
+                                        b'\r\n', self.timeout, int(expect_response))
+        return self._parse_reply(raw)
+
+    @property
+    def model(self) -> str:
+        """
+        Device type reported by IN_TYPE; queried until a reply arrives, then cached.
+        Raises RuntimeError if the device does not answer.
+        """
+        if self._model is None:
+            name = self._send(self.NAMUR_CMDS['IN_TYPE'])
+            if not name:
+                raise RuntimeError("No reply to IN_TYPE")
+            self._model = name
+        return self._model
 
     def detect_model(self) -> str:
         """
-        Ask the device to identify itself.
+        Ask the device to identify itself (only until it has answered once).
         Returns e.g. 'IKARET' for RET control-visc or 'RCT...' for the RCT plate.
+        Raises RuntimeError if the device does not answer.
         """
-        name = self._send(self.NAMUR_CMDS['IN_TYPE'])
+        name = self.model
         print("Detected device model:", name)
         return name
 
@@ -100,33 +172,41 @@ class IkaLabDevice:
         Read current value from channel X.
         channel: 1=temp medium, 2=plate temp, 4=speed, 5=viscosity trend, 7=carrier temp,
                  80=pH, 90=weight
+        Raises ValueError for the viscosity trend on an RCT plate, which lacks it.
         """
-        cmd = self.NAMUR_CMDS['IN_PV'].format(x=channel)
-        return self._send(cmd)
+        query = self._queries.get((self._IN_PV, channel))
+        if query is None:
+            if str(channel) == '5' and 'RCT' in self.model:
+                raise ValueError("Viscosity trend (channel 5) is not supported on RCT plates")
+            query = self._query_for(self._IN_PV, channel)
+        return query()
 
     def get_setpoint(self, channel: Union[int, str]) -> str:
         """Read setpoint for channel X."""
-        cmd = self.NAMUR_CMDS['IN_SP'].format(x=channel)
-        return self._send(cmd)
+        return self._query_for(self._IN_SP, channel)()
 
     def set_setpoint(self, channel: Union[int, str], value: Union[int, float]) -> str:
-        """Set target for channel X to value."""
-        cmd = self.NAMUR_CMDS['OUT_SP'].format(x=channel, val=value)
-        return self._send(cmd)
+        """
+        Set target for channel X to value. Returns the device's echo for the
+        watchdog safe values (channels 12 and 42), "" for other channels.
+        """
+        prefix = self._sp_prefixes.get(channel)
+        if prefix is None:
+            prefix = self._sp_prefixes[channel] = self._OUT_SP(channel, '').encode('ascii')
+        return self._send_frame(prefix + f"{value}\r\n".encode('ascii'),
+                                str(channel) in ('12', '42'))
 
     def remote_on(self, function: Union[int, str]) -> str:
         """Enable remote function X (e.g. stirring=4, heating=2, scale=90)."""
-        cmd = self.NAMUR_CMDS['START'].format(x=function)
-        return self._send(cmd)
+        return self._send(self._START(function), expect_response=False)
 
     def remote_off(self, function: Union[int, str]) -> str:
         """Disable remote function X."""
-        cmd = self.NAMUR_CMDS['STOP'].format(x=function)
-        return self._send(cmd)
+        return self._send(self._STOP(function), expect_response=False)
 
     def reset(self) -> str:
         """Emergency reset: turn off all remote functions."""
-        return self._send(self.NAMUR_CMDS['RESET'])
+        return self._send(self.NAMUR_CMDS['RESET'], expect_response=False)
 
     def set_watchdog(self, mode: int, timeout_s: int) -> str:
         """
@@ -136,9 +216,9 @@ class IkaLabDevice:
         timeout_s: 20–1500 s
         """
         if mode == 1:
-            return self._send(self.NAMUR_CMDS['OUT_WD1'].format(sec=timeout_s))
+            return self._send(self._OUT_WD1(timeout_s))
         elif mode == 2:
-            return self._send(self.NAMUR_CMDS['OUT_WD2'].format(sec=timeout_s))
+            return self._send(self._OUT_WD2(timeout_s))
         else:
             raise ValueError("Watchdog mode must be 1 or 2")
 
@@ -150,9 +230,10 @@ class IkaLabDevice:
 # Example usage
 # ----------------------
 if __name__ == "__main__":
-    dev = IkaLabDevice("/dev/ttyUSB0", 9600)
-    if not dev.ser:
-        print("Could not open serial port.")
+    try:
+        dev = IkaLabDevice("/dev/ttyUSB0", 9600)
+    except RuntimeError as e:
+        print(e)
         exit(1)
 
     model = dev.detect_model()
@@ -7,9 +7,17 @@ Created on Mon Jun  2 09:34:12 2025
 tomasz.stawski@bam.de
 """
 
+import logging
+import os
+import re
+import select
 import serial
 import time
 
+from serialbus import SerialBus, fd_drain, fd_write
+
+logger = logging.getLogger(__name__)
+
 # -----------------------------------------------------------
 # COMMANDS dictionary (class attribute)
 # -----------------------------------------------------------
@@ -42,12 +50,25 @@ COMMANDS = {
     'FSF'      : "FSF{param:d}",         # Flush serial FIFO (if supported)
 }
 
+# Reply frame: optional STX, optional two-digit address, payload, optional ETX
+_REPLY_RE = re.compile(rb'^\x02?(?:\d{2})?(.*?)\x03?\s*$', re.DOTALL)
+
+# Fixed commands encoded once, with their trailing CR, ready to write
+FRAMES = {
+    key: (cmd + "\r").encode("ascii")
+    for key, cmd in COMMANDS.items()
+    if "{" not in cmd
+}
+
 
 class AladdinPump:
     """
     Encapsulates RS-232 communication with a WPI Aladdin syringe pump.
     """
 
+    __slots__ = ('device', 'baud', 'timeout', 'ser', '_lock', '_fd',
+                 '_rxbuf', '_rxview', '_rxpos', '_rxlen')
+
     def __init__(
         self,
         device: str = "/dev/ttyUSB0",
@@ -56,81 +77,172 @@ class AladdinPump:
     ):
         """
         Initialize the pump:
-        - Open the serial port with 8 data bits, no parity, 1 stop bit, no flow control.
+        - Open the serial port with 8 data bits, no parity, 1 stop bit, no flow control,
+          or reuse it if another driver already opened it (see SerialBus).
         - Flush any buffered data.
+        Raises RuntimeError if the port cannot be opened.
         """
         self.device = device
         self.baud = baud
         self.timeout = timeout
 
         try:
-            self.ser = serial.Serial(
-                port=self.device,
-                baudrate=self.baud,
+            self.ser = SerialBus.get(
+                self.device,
+                self.baud,
                 bytesize=serial.EIGHTBITS,
                 parity=serial.PARITY_NONE,
                 stopbits=serial.STOPBITS_ONE,
-                timeout=self.timeout,
-                xonxoff=False,
-                rtscts=False,
-                dsrdtr=False
+                timeout=self.timeout
             )
-            # Give the port a moment to initialize
-            time.sleep(0.1)
-            self.ser.reset_input_buffer()
-            self.ser.reset_output_buffer()
+            self._lock = SerialBus.lock_for(self.device)
+            self._fd = self.ser.fileno()
+            # Receive buffer reused by every reply read (see _read_frame)
+            self._rxbuf = bytearray(256)
+            self._rxview = memoryview(self._rxbuf)
+            self._rxpos = self._rxlen = 0
             print(f"Opened {self.device} @ {self.baud} baud (8N1, no flow control)")
         except Exception as e:
-            print(f"ERROR opening {self.device}: {e}")
-            self.ser = None
+            raise RuntimeError(f"Failed to open {self.device}: {e}") from e
 
     def close(self):
         """
-        Close the serial port if open.
+        Release the serial port; it is closed once no other driver uses it.
+        """
+        if self.ser:
+            if SerialBus.release(self.device):
+                print("Serial port closed.")
+            self.ser = None
+            self._fd = -1
+
+    def send_cmd(self, cmd: str) -> str:
+        """
+        Send an ASCII command (without CR), append '\\r', then read up to the
+        closing ETX (or the port timeout) and return the parsed reply.
         """
-        if self.ser and self.ser.is_open:
-            self.ser.close()
-            print("Serial port closed.")
+        return self._send_frame((cmd + "\r").encode("ascii"))
 
-    def send_cmd(self, cmd: str, pause: float = 0.1) -> str:
+    def _send_frame(self, frame: bytes) -> str:
+        """
+        Write an already encoded, CR-terminated command (e.g. from FRAMES)
+        and return the parsed reply.
+        """
+        with self._lock:
+            self._drain()
+            fd_write(self._fd, frame, self.timeout)
+            return self._parse_reply(self._read_frame())
+
+    def send_batch(self, cmds: list) -> list:
+        """
+        Send several commands in a single write and return their replies in order.
+        The pump handles CR-terminated commands back-to-back and answers each
+        with its own ETX-terminated frame.
+        """
+        return self._send_frames(("\r".join(cmds) + "\r").encode("ascii"), len(cmds))
+
+    def _send_frames(self, frames: bytes, count: int) -> list:
+        """
+        Write `count` already encoded, CR-terminated commands at once and
+        return their parsed replies in order.
+        """
+        read_frame = self._read_frame
+        parse = self._parse_reply
+        with self._lock:
+            self._drain()
+            fd_write(self._fd, frames, self.timeout)
+            return [parse(read_frame()) for _ in range(count)]
+
+    def _drain(self):
+        """
+        Drop stale input before a new command: bytes left in the receive
+        buffer after the last expected reply and anything still queued on
+        the port. Both are logged.
+        """
+        fd_drain(self._fd, self._rxlen - self._rxpos)
+        self._rxpos = self._rxlen = 0
+
+    def _read_frame(self) -> memoryview:
+        """
+        Read one ETX-terminated reply (or whatever arrived before the timeout)
+        into the preallocated receive buffer and return a view of it, valid
+        until the next read. Bytes received past the ETX (the start of the
+        next reply in a batch) are kept for the next call.
         """
-        Send an ASCII command (without CR), append '\\r', then read + return the reply.
+        buf = self._rxbuf
+        view = self._rxview
+        fd = self._fd
+        # Move anything left over from the previous frame to the front
+        n = self._rxlen - self._rxpos
+        if self._rxpos:
+            view[:n] = view[self._rxpos:self._rxlen]
+        end = buf.find(b'\x03', 0, n) + 1
+        deadline = time.monotonic() + self.timeout
+        while not end and n < len(buf):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                break
+            try:
+                got = os.readv(fd, [view[n:]])
+            except BlockingIOError:
+                continue
+            if not got:
+                break
+            end = buf.find(b'\x03', n, n + got) + 1
+            n += got
+        if not end:
+            end = n
+        self._rxpos, self._rxlen = end, n
+        return view[:end]
+
+    @staticmethod
+    def _parse_reply(raw: bytes) -> str:
+        """
+        Decode a raw reply frame.
         Strips STX (0x02), ETX (0x03), and a two-digit address prefix if present.
         """
-        if not self.ser or not self.ser.is_open:
-            raise RuntimeError("Serial port not open")
-        self.ser.write((cmd + "\r").encode("ascii"))
-        time.sleep(pause)
-        raw = self.ser.read_all()
-        text = raw.decode("ascii", errors="ignore")
+        return _REPLY_RE.match(raw).group(1).decode("ascii", errors="ignore").strip()
 
-        # Strip leading STX and trailing ETX if present
-        if text.startswith('\x02') and text.endswith('\x03'):
-            text = text[1:-1]
-        # If first two chars are digits (address), drop them
-        if len(text) >= 2 and text[:2].isdigit():
-            text = text[2:]
-        return text.strip()
+    async def asend_cmd(self, cmd: str) -> str:
+        """
+        Coroutine version of send_cmd: await the ETX that closes the pump's
+        STX/address/status/ETX reply instead of sleeping a fixed pause.
+        """
+        raw = await SerialBus.aexchange(
+            self.device, self._fd, (cmd + "\r").encode("ascii"), b'\x03', self.timeout
+        )
+        return self._parse_reply(raw)
 
-    def wait_until_idle(self, timeout: float = 60.0) -> bool:
+    def wait_until_idle(self, timeout: float = 60.0, expected: float = None) -> bool:
         """
-        Poll 'FUN' every 0.5 s until pump reports completion or timeout expires.
+        Poll 'FUN' until pump reports completion or timeout expires.
         Many Aladdin pumps respond with 'END' or start with 'S' when idle.
+        Without `expected` the pump is polled every 0.5 s. Given the expected
+        duration (s), polls are spaced at a tenth of the expected time left
+        (0.05–5 s), so long runs are polled rarely and the end is caught quickly;
+        once the expected time has passed, every 0.05 s.
         """
         start = time.time()
-        while time.time() - start < timeout:
-            resp = self.send_cmd(COMMANDS['FUN'], pause=0.05)
+        end_time = start + timeout
+        while True:
+            resp = self._send_frame(FRAMES['FUN'])
             if resp.startswith("END") or resp.startswith("S"):
                 return True
-            time.sleep(0.5)
-        return False
+            now = time.time()
+            remaining = end_time - now
+            if remaining <= 0:
+                return False
+            if expected is None:
+                interval = 0.5
+            else:
+                interval = min(5.0, max(0.05, (expected - (now - start)) * 0.1))
+            time.sleep(min(interval, remaining))
 
     def verify(self) -> str:
         """
         Send 'VER' and return pump firmware response.
         Raises RuntimeError if no valid 'SNE' response is received.
         """
-        resp = self.send_cmd(COMMANDS['VER'])
+        resp = self._send_frame(FRAMES['VER'])
         if not resp.startswith("SNE"):
             raise RuntimeError(f"No valid response to VER. Got: {repr(resp)}")
         return resp
@@ -169,13 +281,23 @@ class AladdinPump:
         """
         Send 'RUN' to start infusion or withdrawal.
         """
-        return self.send_cmd(COMMANDS['RUN'])
+        return self._send_frame(FRAMES['RUN'])
+
+    def start(self, direction: str) -> list:
+        """
+        Set direction to 'INF' or 'WDR' and send 'RUN' in the same write, so
+        motion starts without waiting for the DIR reply first.
+        Returns the [DIR, RUN] replies.
+        """
+        if direction not in ("INF", "WDR"):
+            raise ValueError("Direction must be 'INF' or 'WDR'")
+        return self._send_frames(FRAMES['DIR_' + direction] + FRAMES['RUN'], 2)
 
     def stop(self) -> str:
         """
         Send 'STP' for an emergency stop.
         """
-        return self.send_cmd(COMMANDS['STP'])
+        return self._send_frame(FRAMES['STP'])
 
     def safe_mode(self, timeout_sec: int) -> str:
         """
@@ -200,80 +322,66 @@ class AladdinPump:
         1) Verify pump with 'VER'
         2) Set default units to mL/mL-min
         3) Home and wait for 'HOM' to finish
-        4) Set diameter, volume, rate
-        5) Set direction INF and RUN
-        6) Poll status; if no 'END' after timeout, stop and cleanup
+        4) Set diameter, volume, rate, direction INF and RUN (one write)
+        5) Poll status; if no 'END' after timeout, stop and cleanup
         """
+        if rate_ml_per_min <= 0:
+            logger.error("Rate must be positive, got %s mL/min", rate_ml_per_min)
+            return
+
         try:
             fw = self.verify()
-            print("Pump firmware:", fw)
+            logger.info("Pump firmware: %s", fw)
         except RuntimeError as e:
-            print(e)
+            logger.error("%s", e)
             return
 
         # Set default units to mL and mL/min
         resp = self.send_cmd("VOL ML")
-        print("VOL ML →", resp)
+        logger.info("VOL ML → %s", resp)
         resp = self.send_cmd("RAT 0 MM")
-        print("RAT 0 MM →", resp)
+        logger.info("RAT 0 MM → %s", resp)
 
         # Homing
-        print("Sending HOM")
-        resp = self.send_cmd(COMMANDS['HOM'])
-        print("HOM →", resp)
-        print("Waiting for homing to complete")
+        logger.info("Sending HOM")
+        resp = self._send_frame(FRAMES['HOM'])
+        logger.info("HOM → %s", resp)
+        logger.info("Waiting for homing to complete")
         if not self.wait_until_idle(timeout=30.0):
-            print("WARNING: Homing did not complete within 30 s. Check syringe/drive.")
+            logger.warning("Homing did not complete within 30 s. Check syringe/drive.")
             self.stop()
             return
-        print("Homing complete")
-
-        # Set syringe diameter
-        print(f"Setting diameter to {diameter_mm:.2f} mm")
-        resp = self.set_diameter(diameter_mm)
-        print(f"DIA{diameter_mm:.2f} → {resp}")
-
-        # Set volume (20 mL)
-        print(f"Setting volume to {volume_ml:.3f} mL")
-        resp = self.set_volume(volume_ml)
-        print(f"VOL{volume_ml:.3f} → {resp}")
-
-        # Set rate
-        print(f"Setting rate to {rate_ml_per_min:.3f} mL/min")
-        resp = self.set_rate(rate_ml_per_min)
-        print(f"RAT{rate_ml_per_min:.3f} → {resp}")
-
-        # Set direction → INFuse
-        print("Setting direction to INF")
-        resp = self.set_direction("INF")
-        print("DIR INF →", resp)
-
-        # Run infusion
-        print("Starting infusion (RUN)")
-        resp = self.run()
-        print("RUN →", resp)
-
-        # Poll status every 0.5 s, up to max_wait
-        print(f"Waiting for infusion to complete (up to {max_wait:.0f} s)")
-        start = time.time()
-        while time.time() - start < max_wait:
-            status = self.send_cmd(COMMANDS['FUN'], pause=0.05)
-            if status.startswith("END") or status.startswith("S"):
-                print("Pump is idle (infusion complete)")
-                break
-            time.sleep(0.5)
+        logger.info("Homing complete")
+
+        # Set diameter, volume, rate, direction → INFuse, and RUN in one write
+        logger.info("Setting diameter to %.2f mm, volume to %.3f mL, "
+                    "rate to %.3f mL/min, direction to INF",
+                    diameter_mm, volume_ml, rate_ml_per_min)
+        logger.info("Starting infusion (RUN)")
+        cmds = [
+            COMMANDS['DIA'].format(param=diameter_mm),
+            COMMANDS['VOL'].format(param=volume_ml),
+            COMMANDS['RAT'].format(param=rate_ml_per_min),
+            COMMANDS['DIR_INF'],
+            COMMANDS['RUN'],
+        ]
+        for cmd, resp in zip(cmds, self.send_batch(cmds)):
+            logger.info("%s → %s", cmd, resp)
+
+        # Poll status, more often as the expected end approaches, up to max_wait
+        logger.info("Waiting for infusion to complete (up to %.0f s)", max_wait)
+        if self.wait_until_idle(timeout=max_wait, expected=volume_ml / rate_ml_per_min * 60):
+            logger.info("Pump is idle (infusion complete)")
         else:
-            print("WARNING: Timeout waiting for infusion. Pump may be stuck or ticking without motion.")
-            print("Check syringe seating, diameter, and rate.")
+            logger.warning("Timeout waiting for infusion. Pump may be stuck or ticking without motion.")
+            logger.warning("Check syringe seating, diameter, and rate.")
             self.stop()
-            print("STP sent due to timeout")
-            self.close()
+            logger.warning("STP sent due to timeout")
             return
 
         # Cleanup: emergency stop
         self.stop()
-        print("Emergency stop sent")
-        self.close()
+        logger.info("Emergency stop sent")
 
 
 #############################################################################
@@ -291,104 +399,91 @@ class AladdinPump:
         1) Verify pump with 'VER'
         2) Set default units to mL/mL-min
         3) Home and wait for 'HOM' to finish
-        4) Set diameter, volume, rate
-        5) Set direction WDR and RUN
-        6) Poll status; if no 'END' after timeout, stop and cleanup
+        4) Set diameter, volume, rate, direction WDR and RUN (one write)
+        5) Poll status; if no 'END' after timeout, stop and cleanup
         """
+        if rate_ml_per_min <= 0:
+            logger.error("Rate must be positive, got %s mL/min", rate_ml_per_min)
+            return
+
         try:
             fw = self.verify()
-            print("Pump firmware:", fw)
+            logger.info("Pump firmware: %s", fw)
         except RuntimeError as e:
-            print(e)
+            logger.error("%s", e)
             return
 
         # Set default units to mL and mL/min
         resp = self.send_cmd("VOL ML")
-        print("VOL ML →", resp)
+        logger.info("VOL ML → %s", resp)
         resp = self.send_cmd("RAT 0 MM")
-        print("RAT 0 MM →", resp)
+        logger.info("RAT 0 MM → %s", resp)
 
         # Homing
-        print("Sending HOM")
-        resp = self.send_cmd(COMMANDS['HOM'])
-        print("HOM →", resp)
-        print("Waiting for homing to complete")
+        logger.info("Sending HOM")
+        resp = self._send_frame(FRAMES['HOM'])
+        logger.info("HOM → %s", resp)
+        logger.info("Waiting for homing to complete")
         if not self.wait_until_idle(timeout=30.0):
-            print("WARNING: Homing did not complete within 30 s. Check syringe/drive.")
+            logger.warning("Homing did not complete within 30 s. Check syringe/drive.")
             self.stop()
             return
-        print("Homing complete")
-
-        # Set syringe diameter
-        print(f"Setting diameter to {diameter_mm:.2f} mm")
-        resp = self.set_diameter(diameter_mm)
-        print(f"DIA{diameter_mm:.2f} → {resp}")
-
-        # Set volume (20 mL)
-        print(f"Setting volume to {volume_ml:.3f} mL")
-        resp = self.set_volume(volume_ml)
-        print(f"VOL{volume_ml:.3f} → {resp}")
-
-        # Set rate
-        print(f"Setting rate to {rate_ml_per_min:.3f} mL/min")
-        resp = self.set_rate(rate_ml_per_min)
-        print(f"RAT{rate_ml_per_min:.3f} → {resp}")
-
-        # Set direction → WDRaw
-        print("Setting direction to WDR")
-        resp = self.set_direction("WDR")
-        print("DIR WDR →", resp)
-
-        # Run withdrawal
-        print("Starting withdrawal (RUN)")
-        resp = self.run()
-        print("RUN →", resp)
-
-        # Poll status every 0.5 s, up to max_wait
-        print(f"Waiting for withdrawal to complete (up to {max_wait:.0f} s)")
-        start = time.time()
-        while time.time() - start < max_wait:
-            status = self.send_cmd(COMMANDS['FUN'], pause=0.05)
-            if status.startswith("END") or status.startswith("S"):
-                print("Pump is idle (withdrawal complete)")
-                break
-            time.sleep(0.5)
+        logger.info("Homing complete")
+
+        # Set diameter, volume, rate, direction → WDRaw, and RUN in one write
+        logger.info("Setting diameter to %.2f mm, volume to %.3f mL, "
+                    "rate to %.3f mL/min, direction to WDR",
+                    diameter_mm, volume_ml, rate_ml_per_min)
+        logger.info("Starting withdrawal (RUN)")
+        cmds = [
+            COMMANDS['DIA'].format(param=diameter_mm),
+            COMMANDS['VOL'].format(param=volume_ml),
+            COMMANDS['RAT'].format(param=rate_ml_per_min),
+            COMMANDS['DIR_WDR'],
+            COMMANDS['RUN'],
+        ]
+        for cmd, resp in zip(cmds, self.send_batch(cmds)):
+            logger.info("%s → %s", cmd, resp)
+
+        # Poll status, more often as the expected end approaches, up to max_wait
+        logger.info("Waiting for withdrawal to complete (up to %.0f s)", max_wait)
+        if self.wait_until_idle(timeout=max_wait, expected=volume_ml / rate_ml_per_min * 60):
+            logger.info("Pump is idle (withdrawal complete)")
         else:
-            print("WARNING: Timeout waiting for withdrawal. Pump may be stuck or ticking without motion.")
-            print("Verify syringe seating, diameter, and rate.")
+            logger.warning("Timeout waiting for withdrawal. Pump may be stuck or ticking without motion.")
+            logger.warning("Verify syringe seating, diameter, and rate.")
             self.stop()
-            print("STP sent due to timeout")
-            self.close()
+            logger.warning("STP sent due to timeout")
             return
 
         # Cleanup: emergency stop
         self.stop()
-        print("Emergency stop sent")
-        self.close()
+        logger.info("Emergency stop sent")
 
 
 # -----------------------------------------------------------
 # Example usage
 # -----------------------------------------------------------
 if __name__ == "__main__":
-    pump = AladdinPump(device="/dev/ttyUSB0", baud=9600)
-    if pump.ser:
-        pump.run_infusion_test(
-            diameter_mm=10.00,     # 10 mm syringe diameter
-            volume_ml=2.000,      # 20 mL
-            rate_ml_per_min=5.0,  # 20 mL/min
-            max_wait=60.0
-        )
-    else:
-        print("Failed to open serial port. Exiting.")
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
-    pump = AladdinPump(device="/dev/ttyUSB0", baud=9600)
-    if pump.ser:
-        pump.run_withdrawal_test(
-            diameter_mm=10.00,     # 10 mm syringe diameter
-            volume_ml=2.000,      # 20 mL
-            rate_ml_per_min=5.0,  # 20 mL/min
-            max_wait=60.0
-        )
-    else:
+    try:
+        pump = AladdinPump(device="/dev/ttyUSB0", baud=9600)
+    except RuntimeError as e:
+        print(e)
         print("Failed to open serial port. Exiting.")
+        exit(1)
+
+    pump.run_infusion_test(
+        diameter_mm=10.00,     # 10 mm syringe diameter
+        volume_ml=2.000,      # 20 mL
+        rate_ml_per_min=5.0,  # 20 mL/min
+        max_wait=60.0
+    )
+    pump.run_withdrawal_test(
+        diameter_mm=10.00,     # 10 mm syringe diameter
+        volume_ml=2.000,      # 20 mL
+        rate_ml_per_min=5.0,  # 20 mL/min
+        max_wait=60.0
+    )
+    pump.close()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+serialbus.py
+
+Process-wide registry of open serial ports shared by the drivers.
+
+Drivers that talk to the same tty (e.g. several Aladdin pumps told apart by
+ADR, or VICI actuators by ID on one RS-485 line) get the same serial.Serial
+instance and the same lock, so the port is opened and initialized once and
+request/reply exchanges from different drivers never interleave.
+"""
+
+import asyncio
+import logging
+import os
+import select
+import threading
+import time
+
+import serial
+
+try:
+    import termios
+except ImportError:  # not POSIX
+    termios = None
+
+logger = logging.getLogger(__name__)
+
+
+def _enable_low_latency(ser: serial.Serial):
+    """
+    Ask the USB-serial driver to hand bytes over immediately instead of
+    coalescing them for up to 16 ms (ASYNC_LOW_LATENCY). Falls back to the
+    FTDI latency_timer in sysfs; silently does nothing on other adapters.
+    """
+    try:
+        ser.set_low_latency_mode(True)
+        return
+    except (NotImplementedError, OSError, AttributeError, ValueError):
+        pass
+    tty = os.path.basename(os.path.realpath(ser.port))
+    try:
+        with open(f"/sys/bus/usb-serial/devices/{tty}/latency_timer", "w") as f:
+            f.write("1")
+    except OSError:
+        pass
+
+
+def _driver_name(ser: serial.Serial) -> str:
+    """
+    Return the kernel driver bound to the port's tty (e.g. 'ftdi_sio',
+    'pl2303', 'cdc_acm'), or '' if it cannot be determined.
+    """
+    tty = os.path.basename(os.path.realpath(ser.port))
+    link = f"/sys/class/tty/{tty}/device/driver"
+    if not os.path.islink(link):
+        return ""
+    return os.path.basename(os.path.realpath(link))
+
+
+def _flush(ser: serial.Serial):
+    """
+    Discard pending input and output with one tcflush(TCIOFLUSH) ioctl,
+    falling back to pyserial's separate input/output resets.
+    """
+    if termios is not None:
+        try:
+            termios.tcflush(ser.fileno(), termios.TCIOFLUSH)
+            return
+        except (OSError, termios.error):
+            pass
+    ser.reset_input_buffer()
+    ser.reset_output_buffer()
+
+
+def fd_write(fd: int, data: bytes, timeout: float):
+    """
+    Write all of `data` straight to the port's file descriptor with os.write,
+    waiting in select() if the (non-blocking) fd is momentarily full.
+    Raises serial.SerialTimeoutException if it stays full for `timeout` s.
+    """
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(fd, view):]
+        except BlockingIOError:
+            if not select.select([], [fd], [], timeout)[1]:
+                raise serial.SerialTimeoutException("Write timeout")
+
+
+def _discard_input(fd: int, extra: int):
+    """
+    Drop `extra` unexpected bytes read past the end of a reply, and flush
+    whatever else is still queued, so it cannot leak into the next exchange.
+    """
+    logger.warning("Discarding %d unexpected byte(s) after reply on fd %d", extra, fd)
+    if termios is not None:
+        try:
+            termios.tcflush(fd, termios.TCIFLUSH)
+        except (OSError, termios.error):
+            pass
+
+
+def fd_drain(fd: int, pending: int = 0):
+    """
+    Read and drop whatever is already queued on the port before a new command
+    is written (e.g. a late reply to a command that timed out), so it cannot
+    be taken for the reply to the new one. `pending` counts stale bytes the
+    caller has buffered itself; the total is logged like _discard_input does.
+    """
+    dropped = pending
+    while select.select([fd], [], [], 0)[0]:
+        try:
+            chunk = os.read(fd, 256)
+        except BlockingIOError:
+            break
+        if not chunk:
+            break
+        dropped += len(chunk)
+    if dropped:
+        logger.warning("Discarding %d stale byte(s) before command on fd %d", dropped, fd)
+
+
+def fd_read_until(fd: int, terminator: bytes, timeout: float, count: int = 1) -> bytes:
+    """
+    Read from the port's file descriptor with os.read until `count`
+    terminators have arrived or `timeout` s have passed; returns what was read
+    up to and including the last expected terminator. Anything received after
+    it is unexpected: it is logged and the input queue is flushed.
+    """
+    buf = bytearray()
+    deadline = time.monotonic() + timeout
+    while buf.count(terminator) < count:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+            break
+        try:
+            chunk = os.read(fd, 64)
+        except BlockingIOError:
+            continue
+        if not chunk:
+            break
+        buf += chunk
+    end = _reply_end(buf, terminator, count)
+    if 0 <= end < len(buf):
+        _discard_input(fd, len(buf) - end)
+        del buf[end:]
+    return bytes(buf)
+
+
+def _reply_end(buf: bytearray, terminator: bytes, count: int) -> int:
+    """Index just past the `count`-th terminator in buf, or -1 if not there yet."""
+    end = 0
+    for _ in range(count):
+        found = buf.find(terminator, end)
+        if found < 0:
+            return -1
+        end = found + len(terminator)
+    return end
+
+
+class SerialBus:
+    """
+    Reference-counted cache of open serial ports, keyed by device path.
+    """
+
+    _instances = {}
+    _locks = {}
+    _refs = {}
+    _registry_lock = threading.Lock()
+
+    @classmethod
+    def get(
+        cls,
+        port: str,
+        baud: int = 9600,
+        bytesize: int = serial.EIGHTBITS,
+        parity: str = serial.PARITY_NONE,
+        stopbits: float = serial.STOPBITS_ONE,
+        timeout: float = 0.5
+    ) -> serial.Serial:
+        """
+        Return the open serial.Serial for `port`, opening it (no flow control)
+        on first use. Raises ValueError if the port is already open with
+        different line settings. `timeout` only sets pyserial's own read
+        timeout; the drivers pass their own timeout to fd_read_until & co.
+        """
+        with cls._registry_lock:
+            ser = cls._instances.get(port)
+            if ser is not None and ser.is_open:
+                settings = (ser.baudrate, ser.bytesize, ser.parity, ser.stopbits)
+                if settings != (baud, bytesize, parity, stopbits):
+                    raise ValueError(f"{port} is already open with settings {settings}")
+                cls._refs[port] += 1
+                return ser
+
+            # Pass every line setting to the constructor: pyserial then applies
+            # them with a single tcgetattr/tcsetattr at open, whereas setting
+            # baudrate, parity, ... one by one afterwards reconfigures the tty
+            # once per attribute.
+            ser = serial.Serial(
+                port=port,
+                baudrate=baud,
+                bytesize=bytesize,
+                parity=parity,
+                stopbits=stopbits,
+                timeout=timeout,
+                xonxoff=False,
+                rtscts=False,
+                dsrdtr=False
+            )
+            # Older FTDI adapters need a moment to initialize after open;
+            # other adapters are ready at once
+            if _driver_name(ser) == "ftdi_sio":
+                time.sleep(0.1)
+            _flush(ser)
+            _enable_low_latency(ser)
+
+            cls._instances[port] = ser
+            cls._locks.setdefault(port, threading.RLock())
+            cls._refs[port] = 1
+            return ser
+
+    @classmethod
+    def lock_for(cls, port: str) -> threading.RLock:
+        """
+        Return the lock guarding request/reply exchanges on `port`.
+        """
+        with cls._registry_lock:
+            return cls._locks.setdefault(port, threading.RLock())
+
+    @classmethod
+    async def aexchange(
+        cls,
+        port: str,
+        fd: int,
+        frame: bytes,
+        terminator: bytes,
+        timeout: float,
+        count: int = 1
+    ) -> bytes:
+        """
+        Write `frame` and read `count` terminated reply lines (none if
+        count=0) as one exchange, like the drivers' synchronous sends, and
+        return them; a late or missing reply is returned short, not raised.
+        The exchange runs in the loop's default executor under the port's
+        thread lock, so it is serialized with every other exchange on the port,
+        synchronous or not, while the event loop stays free and exchanges on
+        different ports overlap.
+        """
+        def exchange():
+            with cls.lock_for(port):
+                fd_drain(fd)
+                fd_write(fd, frame, timeout)
+                if not count:
+                    return b""
+                return fd_read_until(fd, terminator, timeout, count)
+
+        return await asyncio.get_running_loop().run_in_executor(None, exchange)
+
+    @classmethod
+    def release(cls, port: str) -> bool:
+        """
+        Drop one reference to `port`; close it when the last user releases it.
+        Returns True if the port was closed.
+        """
+        with cls._registry_lock:
+            if port not in cls._refs:
+                return False
+            cls._refs[port] -= 1
+            if cls._refs[port] > 0:
+                return False
+            del cls._refs[port]
+            ser = cls._instances.pop(port)
+            if ser.is_open:
+                ser.close()
+            return True
@@ -9,48 +9,97 @@ Created on Tue Jun 17 13:30:24 2025
 import serial
 import time
 
+from serialbus import SerialBus, fd_drain, fd_read_until, fd_write
+
 class ViciActuator:
     """
     Control a VICI 10-position + common (10+1) MU actuator via RS-232/485.
     See VICI MU Actuator User Manual (V2, April 2023) for details :contentReference[oaicite:0]{index=0}.
     """
 
+    __slots__ = ('port', 'timeout', 'ser', '_lock', '_fd')
+
+    # Commands answering with more than one CR-terminated line
+    _REPLY_LINES = {
+        'STAT': 4,  # Position is = nn / AM = n / NP = nn / SO = nn
+    }
+
     def __init__(self, port: str = "/dev/ttyUSB1", baud: int = 9600, timeout: float = 0.5):
         """
         Open serial port (8N1, no flow control) and flush buffers.
+        Raises RuntimeError if the port cannot be opened.
         """
         self.port = port
+        self.timeout = timeout
         try:
-            self.ser = serial.Serial(port, baud, bytesize=serial.EIGHTBITS,
+            self.ser = SerialBus.get(port, baud, bytesize=serial.EIGHTBITS,
                                      parity=serial.PARITY_NONE,
                                      stopbits=serial.STOPBITS_ONE,
-                                     timeout=timeout,
-                                     xonxoff=False, rtscts=False, dsrdtr=False)
-            time.sleep(0.1)
-            self.ser.reset_input_buffer()
-            self.ser.reset_output_buffer()
+                                     timeout=timeout)
+            self._lock = SerialBus.lock_for(port)
+            self._fd = self.ser.fileno()
         except Exception as e:
-            print(f"ERROR opening {port}: {e}")
-            self.ser = None
+            raise RuntimeError(f"Failed to open {port}: {e}") from e
 
     def close(self):
-        """Close serial port if open."""
-        if self.ser and self.ser.is_open:
-            self.ser.close()
+        """Release serial port; it is closed once no other driver uses it."""
+        if self.ser:
+            SerialBus.release(self.port)
+            self.ser = None
+            self._fd = -1
 
     def send_cmd(self, cmd: str, expect_response: bool = True) -> str:
         """
-        Send cmd + CR. If expect_response, read until CR and return stripped string.
+        Send cmd + CR. If expect_response, read until CR and return stripped string
+        (multi-line replies such as STAT are joined with newlines).
         Some commands (e.g. LRN, CC without stops) return no response.
         """
-        if not self.ser or not self.ser.is_open:
-            raise RuntimeError("Serial port not open")
-        self.ser.write((cmd + "\r").encode('ascii'))
-        if not expect_response:
-            time.sleep(0.05)
-            return ""
-        resp = self.ser.read_until(b'\r').decode('ascii', errors='ignore').strip()
-        return resp
+        fd = self._fd
+        timeout = self.timeout
+        with self._lock:
+            fd_drain(fd)
+            fd_write(fd, (cmd + "\r").encode('ascii'), timeout)
+            if not expect_response:
+                time.sleep(0.05)
+                return ""
+            raw = fd_read_until(fd, b'\r', timeout, count=self._REPLY_LINES.get(cmd, 1))
+        return self._join_lines(raw.split(b'\r')[:self._REPLY_LINES.get(cmd, 1)])
+
+    def send_pipeline(self, cmds: list) -> list:
+        """
+        Send several query commands in one write and return their replies in order.
+        The actuator answers CR-separated commands one after another, so N
+        queries cost one round-trip instead of N. Only use commands that reply;
+        multi-line replies (e.g. STAT) are joined with newlines.
+        """
+        counts = [self._REPLY_LINES.get(cmd, 1) for cmd in cmds]
+        fd = self._fd
+        timeout = self.timeout
+        with self._lock:
+            fd_drain(fd)
+            fd_write(fd, ("\r".join(cmds) + "\r").encode('ascii'), timeout)
+            raw = fd_read_until(fd, b'\r', timeout, count=sum(counts))
+        lines = raw.split(b'\r')
+        replies = []
+        for n in counts:
+            replies.append(self._join_lines(lines[:n]))
+            del lines[:n]
+        return replies
+
+    @staticmethod
+    def _join_lines(lines: list) -> str:
+        """Decode reply lines and join them with newlines."""
+        return "\n".join(line.decode('ascii', errors='ignore').strip() for line in lines).strip()
+
+    async def asend_cmd(self, cmd: str, expect_response: bool = True) -> str:
+        """
+        Coroutine version of send_cmd: await the CR-terminated reply on the
+        event loop so the valve can be driven alongside other devices.
+        """
+        count = self._REPLY_LINES.get(cmd, 1) if expect_response else 0
+        raw = await SerialBus.aexchange(self.port, self._fd, (cmd + "\r").encode('ascii'),
+                                        b'\r', self.timeout, count)
+        return self._join_lines(raw.split(b'\r')[:count])
 
     # — Basic actuator commands —
 
@@ -67,7 +116,7 @@ class ViciActuator:
         return self.send_cmd("CP")
 
     def get_status(self) -> str:
-        """STAT: display full actuator status (mode, NP, SO, position)."""
+        """STAT: display full actuator status (position, mode, NP, SO), one per line."""
         return self.send_cmd("STAT")
 
     def get_firmware(self, board: int = None) -> str:
@@ -78,6 +127,14 @@ class ViciActuator:
         cmd = "VR" if board is None else f"VR{board}"
         return self.send_cmd(cmd)
 
+    def snapshot(self) -> dict:
+        """
+        CP + STAT + TM in one pipelined exchange: position, status (four
+        lines, see get_status), last move time.
+        """
+        position, status, move_time = self.send_pipeline(["CP", "STAT", "TM"])
+        return {"position": position, "status": status, "move_time": move_time}
+
     # — Mode and configuration —
 
     def get_mode(self) -> str:
@@ -229,16 +286,19 @@ class ViciActuator:
 
 
 if __name__ == "__main__":
-    valve = ViciActuator(port="/dev/ttyUSB0", baud=9600)
-    if valve.ser:
-        # Configure for a 10-position valve in multiposition mode
-        print(valve.set_mode(3))   # AM3 → multiposition
-        print(valve.set_np(10))    # NP10 → 10 positions
-        print(valve.home())        # HM → go to position 1
-        # Move to port 5 (common plus port 5)
-        valve.go(1)
-        # Confirm position
-        print(valve.get_position())  # CP → should return “Position is = 5”
-        valve.close()
-    else:
+    try:
+        valve = ViciActuator(port="/dev/ttyUSB0", baud=9600)
+    except RuntimeError as e:
+        print(e)
         print("Failed to open actuator serial port.")
+        exit(1)
+
+    # Configure for a 10-position valve in multiposition mode
+    print(valve.set_mode(3))   # AM3 → multiposition
+    print(valve.set_np(10))    # NP10 → 10 positions
+    print(valve.home())        # HM → go to position 1
+    # Move to port 5 (common plus port 5)
+    valve.go(1)
+    # Confirm position
+    print(valve.get_position())  # CP → should return “Position is = 5”
+    valve.close()